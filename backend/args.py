@@ -53,8 +53,12 @@ parser.add_argument("--always-offload-from-vram", action="store_true")
 parser.add_argument("--pytorch-deterministic", action="store_true")
 
 parser.add_argument("--cuda-malloc", action="store_true")
+parser.add_argument("--disable-expandable-segments", action="store_true")
+parser.add_argument("--aggressive-empty-cache", action="store_true")
 parser.add_argument("--cuda-stream", action="store_true")
 parser.add_argument("--pin-shared-memory", action="store_true")
+parser.add_argument("--mmap-torch-files", action="store_true")
+parser.add_argument("--fast-fp8-matmul", action="store_true")
 
 parser.add_argument("--disable-gpu-warning", action="store_true")
 
@@ -16,6 +16,39 @@ from backend import utils
 from modules.shared import opts
 
 
+def concat_conditioning(tensors, dim, zero=False, keep_last=False):
+    # Same as torch.cat, but writes into one output without zeros_like/repeat temporaries.
+    # The output must stay fresh because webui caches conds across steps and images.
+    first = tensors[0]
+    shape = list(first.shape)
+    shape[dim] = sum(t.shape[dim] for t in tensors)
+    result = first.new_empty(shape)
+
+    offset = 0
+    for i, t in enumerate(tensors):
+        part = result.narrow(dim, offset, t.shape[dim])
+        offset += t.shape[dim]
+        if zero and not (keep_last and i == len(tensors) - 1):
+            part.zero_()
+        else:
+            part.copy_(t.expand_as(part))
+
+    return result
+
+
+def get_size_embedding(embedder, cache, values, like, max_size=16):
+    # Shared by the SDXL base and refiner engines. Only a few resolutions are in use at once,
+    # so the cache is simply cleared when it fills up.
+    key = (values, like.dtype, like.device)
+    flat = cache.get(key, None)
+    if flat is None:
+        if len(cache) >= max_size:
+            cache.clear()
+        flat = torch.flatten(embedder(torch.Tensor(values))).unsqueeze(dim=0).to(like)
+        cache[key] = flat
+    return flat
+
+
 class StableDiffusionXL(ForgeDiffusionEngine):
     matched_guesses = [model_list.SDXL]
 
@@ -70,6 +103,7 @@ class StableDiffusionXL(ForgeDiffusionEngine):
         )
 
         self.embedder = Timestep(256)
+        self.size_embeddings = {}
 
         self.forge_objects = ForgeObjects(unet=unet, clip=clip, vae=vae, clipvision=None)
         self.forge_objects_original = self.forge_objects.shallow_copy()
@@ -98,24 +132,13 @@ class StableDiffusionXL(ForgeDiffusionEngine):
         target_width = width
         target_height = height
 
-        out = [
-            self.embedder(torch.Tensor([height])), self.embedder(torch.Tensor([width])),
-            self.embedder(torch.Tensor([crop_h])), self.embedder(torch.Tensor([crop_w])),
-            self.embedder(torch.Tensor([target_height])), self.embedder(torch.Tensor([target_width]))
-        ]
-
-        flat = torch.flatten(torch.cat(out)).unsqueeze(dim=0).repeat(clip_pooled.shape[0], 1).to(clip_pooled)
+        flat = get_size_embedding(self.embedder, self.size_embeddings, (height, width, crop_h, crop_w, target_height, target_width), like=clip_pooled)
 
         force_zero_negative_prompt = is_negative_prompt and all(x == '' for x in prompt)
 
-        if force_zero_negative_prompt:
-            clip_pooled = torch.zeros_like(clip_pooled)
-            cond_l = torch.zeros_like(cond_l)
-            cond_g = torch.zeros_like(cond_g)
-
         cond = dict(
-            crossattn=torch.cat([cond_l, cond_g], dim=2),
-            vector=torch.cat([clip_pooled, flat], dim=1),
+            crossattn=concat_conditioning([cond_l, cond_g], dim=2, zero=force_zero_negative_prompt),
+            vector=concat_conditioning([clip_pooled, flat], dim=1, zero=force_zero_negative_prompt, keep_last=True),
         )
 
         return cond
@@ -192,6 +215,7 @@ class StableDiffusionXLRefiner(ForgeDiffusionEngine):
         )
 
         self.embedder = Timestep(256)
+        self.size_embeddings = {}
 
         self.forge_objects = ForgeObjects(unet=unet, clip=clip, vae=vae, clipvision=None)
         self.forge_objects_original = self.forge_objects.shallow_copy()
@@ -217,23 +241,16 @@ class StableDiffusionXLRefiner(ForgeDiffusionEngine):
         crop_h = opts.sdxl_crop_top
         aesthetic = opts.sdxl_refiner_low_aesthetic_score if is_negative_prompt else opts.sdxl_refiner_high_aesthetic_score
 
-        out = [
-            self.embedder(torch.Tensor([height])), self.embedder(torch.Tensor([width])),
-            self.embedder(torch.Tensor([crop_h])), self.embedder(torch.Tensor([crop_w])),
-            self.embedder(torch.Tensor([aesthetic]))
-        ]
-
-        flat = torch.flatten(torch.cat(out)).unsqueeze(dim=0).repeat(clip_pooled.shape[0], 1).to(clip_pooled)
+        flat = get_size_embedding(self.embedder, self.size_embeddings, (height, width, crop_h, crop_w, aesthetic), like=clip_pooled)
 
         force_zero_negative_prompt = is_negative_prompt and all(x == '' for x in prompt)
 
         if force_zero_negative_prompt:
-            clip_pooled = torch.zeros_like(clip_pooled)
             cond_g = torch.zeros_like(cond_g)
 
         cond = dict(
             crossattn=cond_g,
-            vector=torch.cat([clip_pooled, flat], dim=1),
+            vector=concat_conditioning([clip_pooled, flat], dim=1, zero=force_zero_negative_prompt, keep_last=True),
         )
 
         return cond
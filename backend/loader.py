@@ -1,17 +1,22 @@
 import os
+import re
+import copy
 import torch
 import logging
 import importlib
+import functools
 
 import backend.args
 import huggingface_guess
 
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 from diffusers import DiffusionPipeline
 from transformers import modeling_utils
 
 from backend import memory_management
 from backend.utils import read_arbitrary_config, load_torch_file, beautiful_print_gguf_state_dict_statics
-from backend.state_dict import try_filter_state_dict, load_state_dict
+from backend.state_dict import partition_state_dict, load_state_dict
 from backend.operations import using_forge_operations
 from backend.nn.vae import IntegratedAutoencoderKL
 from backend.nn.clip import IntegratedCLIP
@@ -27,10 +32,47 @@ from backend.diffusion_engine.chroma import Chroma
 
 possible_models = [StableDiffusion, StableDiffusion2, StableDiffusionXLRefiner, StableDiffusionXL, StableDiffusion3, Chroma, Flux]
 
+prediction_types = MappingProxyType({
+    'EPS': 'epsilon',
+    'V_PREDICTION': 'v_prediction',
+    'EDM': 'edm',
+})
+
 
 logging.getLogger("diffusers").setLevel(logging.ERROR)
 dir_path = os.path.dirname(__file__)
 
+# renames whole dot-separated key components, e.g. "enc.blk.0.attn_q.weight" -> "encoder.block.0.layer.0.SelfAttention.q.weight"
+wierd_t5_format_from_city96 = {
+    "enc": "encoder",
+    "blk": "block",
+    "token_embd": "shared",
+    "output_norm": "final_layer_norm",
+    "attn_q": "layer.0.SelfAttention.q",
+    "attn_k": "layer.0.SelfAttention.k",
+    "attn_v": "layer.0.SelfAttention.v",
+    "attn_o": "layer.0.SelfAttention.o",
+    "attn_norm": "layer.0.layer_norm",
+    "attn_rel_b": "layer.0.SelfAttention.relative_attention_bias",
+    "ffn_up": "layer.1.DenseReluDense.wi_1",
+    "ffn_down": "layer.1.DenseReluDense.wo",
+    "ffn_gate": "layer.1.DenseReluDense.wi_0",
+    "ffn_norm": "layer.1.layer_norm",
+}
+wierd_t5_format_from_city96_pattern = re.compile(r'(?<![^.])(' + '|'.join(map(re.escape, wierd_t5_format_from_city96)) + r')(?![^.])')
+
+
+@functools.lru_cache(maxsize=32)
+def load_config_from_disk(loader, path, mtime):
+    return loader(path)
+
+
+def load_config_cached(loader, path, filename='config.json'):
+    # keyed on mtime so that edited config files are picked up, copied so that callers can modify the result
+    file_path = os.path.join(path, filename)
+    mtime = os.path.getmtime(file_path) if os.path.exists(file_path) else None
+    return copy.deepcopy(load_config_from_disk(loader, path, mtime))
+
 
 def load_huggingface_component(guess, component_name, lib_name, cls_name, repo_path, state_dict):
     config_path = os.path.join(repo_path, component_name)
@@ -50,7 +92,7 @@ def load_huggingface_component(guess, component_name, lib_name, cls_name, repo_p
         if cls_name in ['AutoencoderKL']:
             assert isinstance(state_dict, dict) and len(state_dict) > 16, 'You do not have VAE state dict!'
 
-            config = IntegratedAutoencoderKL.load_config(config_path)
+            config = load_config_cached(IntegratedAutoencoderKL.load_config, config_path)
 
             with using_forge_operations(device=memory_management.cpu, dtype=memory_management.vae_dtype()):
                 model = IntegratedAutoencoderKL.from_config(config)
@@ -63,7 +105,7 @@ def load_huggingface_component(guess, component_name, lib_name, cls_name, repo_p
             assert isinstance(state_dict, dict) and len(state_dict) > 16, 'You do not have CLIP state dict!'
 
             from transformers import CLIPTextConfig, CLIPTextModel
-            config = CLIPTextConfig.from_pretrained(config_path)
+            config = load_config_cached(CLIPTextConfig.from_pretrained, config_path)
 
             to_args = dict(device=memory_management.cpu, dtype=memory_management.text_encoder_dtype())
 
@@ -82,7 +124,7 @@ def load_huggingface_component(guess, component_name, lib_name, cls_name, repo_p
             assert isinstance(state_dict, dict) and len(state_dict) > 16, 'You do not have T5 state dict!'
 
             from backend.nn.t5 import IntegratedT5
-            config = read_arbitrary_config(config_path)
+            config = load_config_cached(read_arbitrary_config, config_path)
 
             storage_dtype = memory_management.text_encoder_dtype()
             state_dict_dtype = memory_management.state_dict_dtype(state_dict)
@@ -156,7 +198,9 @@ def load_huggingface_component(guess, component_name, lib_name, cls_name, repo_p
                 need_manual_cast = storage_dtype != computation_dtype
                 to_args = dict(device=initial_device, dtype=storage_dtype)
 
-                with using_forge_operations(**to_args, manual_cast_enabled=need_manual_cast):
+                fp8_matmul_enabled = memory_management.should_use_fp8(load_device, storage_dtype)
+
+                with using_forge_operations(**to_args, manual_cast_enabled=need_manual_cast, fp8_matmul_enabled=fp8_matmul_enabled):
                     model = model_loader(unet_config).to(**to_args)
 
             load_state_dict(model, state_dict)
@@ -183,37 +227,30 @@ def replace_state_dict(sd, asd, guess):
     text_encoder_key_prefix = guess.text_encoder_key_prefix[0]
 
     if 'enc.blk.0.attn_k.weight' in asd:
-        wierd_t5_format_from_city96 = {
-            "enc.": "encoder.",
-            ".blk.": ".block.",
-            "token_embd": "shared",
-            "output_norm": "final_layer_norm",
-            "attn_q": "layer.0.SelfAttention.q",
-            "attn_k": "layer.0.SelfAttention.k",
-            "attn_v": "layer.0.SelfAttention.v",
-            "attn_o": "layer.0.SelfAttention.o",
-            "attn_norm": "layer.0.layer_norm",
-            "attn_rel_b": "layer.0.SelfAttention.relative_attention_bias",
-            "ffn_up": "layer.1.DenseReluDense.wi_1",
-            "ffn_down": "layer.1.DenseReluDense.wo",
-            "ffn_gate": "layer.1.DenseReluDense.wi_0",
-            "ffn_norm": "layer.1.layer_norm",
-        }
         wierd_t5_pre_quant_keys_from_city96 = ['shared.weight']
-        asd_new = {}
-        for k, v in asd.items():
-            for s, d in wierd_t5_format_from_city96.items():
-                k = k.replace(s, d)
-            asd_new[k] = v
+        rename = lambda m: wierd_t5_format_from_city96[m.group(1)]
+        asd_new = {wierd_t5_format_from_city96_pattern.sub(rename, k): v for k, v in asd.items()}
         for k in wierd_t5_pre_quant_keys_from_city96:
             asd_new[k] = asd_new[k].dequantize_as_pytorch_parameter()
         asd.clear()
         asd = asd_new
 
-    if "decoder.conv_in.weight" in asd:
-        keys_to_delete = [k for k in sd if k.startswith(vae_key_prefix)]
+    is_vae = "decoder.conv_in.weight" in asd
+    is_t5 = 'encoder.block.0.layer.0.SelfAttention.k.weight' in asd
+
+    # drop the weights being replaced, sweeping sd once for all prefixes
+    stale_prefixes = []
+    if is_vae:
+        stale_prefixes.append(vae_key_prefix)
+    if is_t5:
+        stale_prefixes.append(f"{text_encoder_key_prefix}t5xxl.")
+    if stale_prefixes:
+        stale_prefixes = tuple(stale_prefixes)
+        keys_to_delete = [k for k in sd if k.startswith(stale_prefixes)]
         for k in keys_to_delete:
             del sd[k]
+
+    if is_vae:
         for k, v in asd.items():
             sd[vae_key_prefix + k] = v
 
@@ -429,10 +466,7 @@ def replace_state_dict(sd, asd, guess):
                         sd[new_k] = v
 
 
-    if 'encoder.block.0.layer.0.SelfAttention.k.weight' in asd:
-        keys_to_delete = [k for k in sd if k.startswith(f"{text_encoder_key_prefix}t5xxl.")]
-        for k in keys_to_delete:
-            del sd[k]
+    if is_t5:
         for k, v in asd.items():
             sd[f"{text_encoder_key_prefix}t5xxl.transformer.{k}"] = v
 
@@ -463,22 +497,21 @@ def split_state_dict(sd, additional_state_dicts: list = None):
 
     sd = guess.process_vae_state_dict(sd)
 
-    state_dict = {
-        guess.unet_target: try_filter_state_dict(sd, guess.unet_key_prefix),
-        guess.vae_target: try_filter_state_dict(sd, guess.vae_key_prefix)
-    }
+    state_dict = partition_state_dict(sd, {
+        guess.unet_target: guess.unet_key_prefix,
+        guess.vae_target: guess.vae_key_prefix
+    })
 
     sd = guess.process_clip_state_dict(sd)
 
-    for k, v in guess.clip_target.items():
-        state_dict[v] = try_filter_state_dict(sd, [k + '.'])
-
-    state_dict['ignore'] = sd
+    state_dict.update(partition_state_dict(sd, {v: [k + '.'] for k, v in guess.clip_target.items()}))
 
     print_dict = {k: len(v) for k, v in state_dict.items()}
+    print_dict['ignore'] = len(sd)
     print(f'StateDict Keys: {print_dict}')
 
-    del state_dict['ignore']
+    # everything still in sd is not routed to any component
+    sd.clear()
 
     return state_dict, guess
 
@@ -515,15 +548,26 @@ def forge_loader(sd, additional_state_dicts=None):
     repo_name = estimated_config.huggingface_repo
 
     local_path = os.path.join(dir_path, 'huggingface', repo_name)
-    config: dict = DiffusionPipeline.load_config(local_path)
+    config: dict = load_config_cached(DiffusionPipeline.load_config, local_path, filename='model_index.json')
     huggingface_components = {}
-    for component_name, v in config.items():
-        if isinstance(v, list) and len(v) == 2:
-            lib_name, cls_name = v
-            component_sd = state_dicts.get(component_name, None)
-            component = load_huggingface_component(estimated_config, component_name, lib_name, cls_name, local_path, component_sd)
-            if component_sd is not None:
-                del state_dicts[component_name]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        file_only_components = {}
+        for component_name, v in config.items():
+            if isinstance(v, list) and len(v) == 2:
+                lib_name, cls_name = v
+                if component_name == 'scheduler' or component_name.startswith('tokenizer'):
+                    # only read from disk, so they can load while the models are being built
+                    file_only_components[component_name] = executor.submit(load_huggingface_component, estimated_config, component_name, lib_name, cls_name, local_path, None)
+                    continue
+                component_sd = state_dicts.pop(component_name, None)
+                component = load_huggingface_component(estimated_config, component_name, lib_name, cls_name, local_path, component_sd)
+                if component_sd is not None:
+                    # tensors the model did not adopt (e.g. cast to another storage dtype) can be freed before the next component
+                    component_sd.clear()
+                if component is not None:
+                    huggingface_components[component_name] = component
+        for component_name, future in file_only_components.items():
+            component = future.result()
             if component is not None:
                 huggingface_components[component_name] = component
 
@@ -536,18 +580,13 @@ def forge_loader(sd, additional_state_dicts=None):
         config_filename = os.path.splitext(sd)[0] + '.yaml'
         if Path(config_filename).is_file():
             with open(config_filename, 'r') as stream:
-                yaml_config = yaml.safe_load(stream)
+                yaml_config = yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
     except ImportError:
         pass
 
     # Fix Huggingface prediction type using .yaml config or estimated config detection
-    prediction_types = {
-        'EPS': 'epsilon',
-        'V_PREDICTION': 'v_prediction',
-        'EDM': 'edm',
-    }
-
-    has_prediction_type = 'scheduler' in huggingface_components and hasattr(huggingface_components['scheduler'], 'config') and 'prediction_type' in huggingface_components['scheduler'].config
+    scheduler_config = getattr(huggingface_components.get('scheduler', None), 'config', None)
+    has_prediction_type = scheduler_config is not None and 'prediction_type' in scheduler_config
 
     if yaml_config is not None:
         yaml_config_prediction_type: str = (
@@ -562,9 +601,9 @@ def forge_loader(sd, additional_state_dicts=None):
 
     if has_prediction_type:
         if yaml_config_prediction_type:
-            huggingface_components['scheduler'].config.prediction_type = yaml_config_prediction_type
+            scheduler_config.prediction_type = yaml_config_prediction_type
         else:
-            huggingface_components['scheduler'].config.prediction_type = prediction_types.get(estimated_config.model_type.name, huggingface_components['scheduler'].config.prediction_type)
+            scheduler_config.prediction_type = prediction_types.get(estimated_config.model_type.name, scheduler_config.prediction_type)
 
     if not chroma_is_in_huggingface_guess and estimated_config.huggingface_repo == "Chroma":
         return Chroma(estimated_config=estimated_config, huggingface_components=huggingface_components)
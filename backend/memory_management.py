@@ -3,15 +3,19 @@
 import sys
 import time
 import psutil
+import functools
+import importlib.util
 import torch
 import platform
 
 from enum import Enum
+from collections import Counter, defaultdict
 from backend import stream, utils
 from backend.args import args
 
 
 cpu = torch.device('cpu')
+mps = torch.device('mps')
 
 
 class VRAMState(Enum):
@@ -55,32 +59,39 @@ if args.directml is not None:
         directml_device = torch_directml.device(device_index)
     print("Using directml with device: {}".format(torch_directml.device_name(device_index)))
 
-try:
-    import intel_extension_for_pytorch as ipex
+if importlib.util.find_spec('intel_extension_for_pytorch') is not None:
+    try:
+        import intel_extension_for_pytorch as ipex
 
-    if torch.xpu.is_available():
-        xpu_available = True
-except:
-    pass
+        xpu_available = torch.xpu.is_available()
+    except Exception as e:
+        print(f'Failed to load intel_extension_for_pytorch: {e}')
 
-try:
-    if torch.backends.mps.is_available():
-        cpu_state = CPUState.MPS
-        import torch.mps
-except:
-    pass
+if hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
+    cpu_state = CPUState.MPS
+    import torch.mps
 
 if args.always_cpu:
     cpu_state = CPUState.CPU
 
 
+# cpu_state and the backends are settled by now and never change afterwards
+IS_INTEL_XPU = cpu_state == CPUState.GPU and xpu_available
+IS_NVIDIA = cpu_state == CPUState.GPU and bool(torch.version.cuda)
+
+
 def is_intel_xpu():
-    global cpu_state
-    global xpu_available
-    if cpu_state == CPUState.GPU:
-        if xpu_available:
-            return True
-    return False
+    return IS_INTEL_XPU
+
+
+accelerator_devices = {}
+
+
+def get_accelerator_device(device_type, index):
+    device = accelerator_devices.get((device_type, index), None)
+    if device is None:
+        device = accelerator_devices[(device_type, index)] = torch.device(device_type, index)
+    return device
 
 
 def get_torch_device():
@@ -90,14 +101,17 @@ def get_torch_device():
         global directml_device
         return directml_device
     if cpu_state == CPUState.MPS:
-        return torch.device("mps")
+        return mps
     if cpu_state == CPUState.CPU:
-        return torch.device("cpu")
+        return cpu
     else:
-        if is_intel_xpu():
-            return torch.device("xpu", torch.xpu.current_device())
+        if IS_INTEL_XPU:
+            return get_accelerator_device("xpu", torch.xpu.current_device())
         else:
-            return torch.device(torch.cuda.current_device())
+            return get_accelerator_device("cuda", torch.cuda.current_device())
+
+
+TOTAL_RAM = psutil.virtual_memory().total
 
 
 def get_total_memory(dev=None, torch_total_too=False):
@@ -106,7 +120,7 @@ def get_total_memory(dev=None, torch_total_too=False):
         dev = get_torch_device()
 
     if hasattr(dev, 'type') and (dev.type == 'cpu' or dev.type == 'mps'):
-        mem_total = psutil.virtual_memory().total
+        mem_total = TOTAL_RAM
         mem_total_torch = mem_total
     else:
         if directml_enabled:
@@ -131,18 +145,12 @@ def get_total_memory(dev=None, torch_total_too=False):
 
 
 total_vram = get_total_memory(get_torch_device()) / (1024 * 1024)
-total_ram = psutil.virtual_memory().total / (1024 * 1024)
+total_ram = TOTAL_RAM / (1024 * 1024)
 print("Total VRAM {:0.0f} MB, total RAM {:0.0f} MB".format(total_vram, total_ram))
 
-try:
-    print("pytorch version: {}".format(torch.version.__version__))
-except:
-    pass
+print("pytorch version: {}".format(torch.version.__version__))
 
-try:
-    OOM_EXCEPTION = torch.cuda.OutOfMemoryError
-except:
-    OOM_EXCEPTION = Exception
+OOM_EXCEPTION = getattr(torch.cuda, 'OutOfMemoryError', Exception)
 
 if directml_enabled:
     OOM_EXCEPTION = Exception
@@ -151,35 +159,38 @@ XFORMERS_VERSION = ""
 XFORMERS_ENABLED_VAE = True
 if args.disable_xformers:
     XFORMERS_IS_AVAILABLE = False
+elif importlib.util.find_spec('xformers') is None:
+    XFORMERS_IS_AVAILABLE = False
 else:
     try:
         import xformers
         import xformers.ops
 
-        XFORMERS_IS_AVAILABLE = True
-        try:
-            XFORMERS_IS_AVAILABLE = xformers._has_cpp_library
-        except:
-            pass
-        try:
-            XFORMERS_VERSION = xformers.version.__version__
+        XFORMERS_IS_AVAILABLE = getattr(xformers, '_has_cpp_library', True)
+        XFORMERS_VERSION = getattr(getattr(xformers, 'version', None), '__version__', '')
+        if XFORMERS_VERSION:
             print("xformers version: {}".format(XFORMERS_VERSION))
             if XFORMERS_VERSION.startswith("0.0.18"):
                 print("\nWARNING: This version of xformers has a major bug where you will get black images when generating high resolution images.")
                 print("Please downgrade or upgrade xformers to a different version.\n")
                 XFORMERS_ENABLED_VAE = False
-        except:
-            pass
-    except:
+    except Exception as e:
+        print(f'Failed to load xformers: {e}')
         XFORMERS_IS_AVAILABLE = False
 
 
+nvidia_10_series = ("1080", "1070", "titan x", "p3000", "p3200", "p4000", "p4200", "p5000", "p5200", "p6000", "1060", "1050", "p40", "p100", "p6", "p4")
+nvidia_16_series = ("1660", "1650", "1630", "T500", "T550", "T600", "MX550", "MX450", "CMP 30HX", "T2000", "T1000", "T1200")
+
+
+@functools.lru_cache(maxsize=None)
+def get_cuda_device_properties(device):
+    # Device properties never change within a process, so ask the driver once per device.
+    return torch.cuda.get_device_properties(device)
+
+
 def is_nvidia():
-    global cpu_state
-    if cpu_state == CPUState.GPU:
-        if torch.version.cuda:
-            return True
-    return False
+    return IS_NVIDIA
 
 
 ENABLE_PYTORCH_ATTENTION = False
@@ -187,7 +198,7 @@ if args.attention_pytorch:
     ENABLE_PYTORCH_ATTENTION = True
     XFORMERS_IS_AVAILABLE = False
 
-VAE_DTYPES = [torch.float32]
+VAE_DTYPES = (torch.float32, )
 
 try:
     if is_nvidia():
@@ -195,19 +206,19 @@ try:
         if int(torch_version[0]) >= 2:
             if ENABLE_PYTORCH_ATTENTION == False and args.attention_split == False and args.attention_quad == False:
                 ENABLE_PYTORCH_ATTENTION = True
-            if torch.cuda.is_bf16_supported() and torch.cuda.get_device_properties(torch.cuda.current_device()).major >= 8:
-                VAE_DTYPES = [torch.bfloat16] + VAE_DTYPES
+            if torch.cuda.is_bf16_supported() and get_cuda_device_properties(torch.cuda.current_device()).major >= 8:
+                VAE_DTYPES = (torch.bfloat16, ) + VAE_DTYPES
     if is_intel_xpu():
         if args.attention_split == False and args.attention_quad == False:
             ENABLE_PYTORCH_ATTENTION = True
-except:
+except Exception:
     pass
 
 if is_intel_xpu():
-    VAE_DTYPES = [torch.bfloat16] + VAE_DTYPES
+    VAE_DTYPES = (torch.bfloat16, ) + VAE_DTYPES
 
 if args.vae_in_cpu:
-    VAE_DTYPES = [torch.float32]
+    VAE_DTYPES = (torch.float32, )
 
 VAE_ALWAYS_TILED = False
 
@@ -260,10 +271,7 @@ if PIN_SHARED_MEMORY:
 def get_torch_device_name(device):
     if hasattr(device, 'type'):
         if device.type == "cuda":
-            try:
-                allocator_backend = torch.cuda.get_allocator_backend()
-            except:
-                allocator_backend = ""
+            allocator_backend = torch.cuda.get_allocator_backend() if hasattr(torch.cuda, 'get_allocator_backend') else ""
             return "{} {} : {}".format(device, torch.cuda.get_device_name(device), allocator_backend)
         else:
             return "{}".format(device.type)
@@ -289,26 +297,16 @@ current_loaded_models = []
 
 
 def state_dict_size(sd, exclude_device=None):
-    module_mem = 0
-    for k in sd:
-        t = sd[k]
-
-        if exclude_device is not None:
-            if t.device == exclude_device:
-                continue
-
-        module_mem += t.nelement() * t.element_size()
-    return module_mem
+    return sum(t.nelement() * t.element_size() for t in sd.values() if exclude_device is None or t.device != exclude_device)
 
 
 def state_dict_parameters(sd):
-    module_mem = 0
-    for k, v in sd.items():
-        module_mem += v.nelement()
-    return module_mem
+    return sum(v.nelement() for v in sd.values())
 
 
 def state_dict_dtype(state_dict):
+    dtype_counts = Counter()
+
     for k, v in state_dict.items():
         if hasattr(v, 'gguf_cls'):
             return 'gguf'
@@ -316,25 +314,13 @@ def state_dict_dtype(state_dict):
             return 'nf4'
         if 'bitsandbytes__fp4' in k:
             return 'fp4'
+        dtype_counts[v.dtype] += 1
 
-    dtype_counts = {}
-
-    for tensor in state_dict.values():
-        dtype = tensor.dtype
-        if dtype in dtype_counts:
-            dtype_counts[dtype] += 1
-        else:
-            dtype_counts[dtype] = 1
-
-    major_dtype = None
-    max_count = 0
-
-    for dtype, count in dtype_counts.items():
-        if count > max_count:
-            max_count = count
-            major_dtype = dtype
+    if not dtype_counts:
+        return None
 
-    return major_dtype
+    # ties go to the dtype seen first, as before
+    return dtype_counts.most_common(1)[0][0]
 
 
 def bake_gguf_model(model):
@@ -353,6 +339,21 @@ def bake_gguf_model(model):
     return model
 
 
+def parameter_size(p):
+    t = p.data
+    element_size = t.element_size()
+
+    if getattr(p, 'quant_type', None) in ['fp4', 'nf4']:
+        if element_size > 1:
+            # not quanted yet
+            element_size = 0.55  # a bit more than 0.5 because of quant state parameters
+        else:
+            # quanted
+            element_size = 1.1  # a bit more than 0.5 because of quant state parameters
+
+    return t.nelement() * element_size
+
+
 def module_size(module, exclude_device=None, include_device=None, return_split=False):
     module_mem = 0
     weight_mem = 0
@@ -369,20 +370,11 @@ def module_size(module, exclude_device=None, include_device=None, return_split=F
             if t.device != include_device:
                 continue
 
-        element_size = t.element_size()
-
-        if getattr(p, 'quant_type', None) in ['fp4', 'nf4']:
-            if element_size > 1:
-                # not quanted yet
-                element_size = 0.55  # a bit more than 0.5 because of quant state parameters
-            else:
-                # quanted
-                element_size = 1.1  # a bit more than 0.5 because of quant state parameters
-
-        module_mem += t.nelement() * element_size
+        p_mem = parameter_size(p)
+        module_mem += p_mem
 
         if k in weight_patterns:
-            weight_mem += t.nelement() * element_size
+            weight_mem += p_mem
 
     if return_split:
         return module_mem, weight_mem, module_mem - weight_mem
@@ -402,6 +394,36 @@ def module_move(module, device, recursive=True, excluded_pattens=[]):
     return module
 
 
+def pin_tensors(tensors, chunk_size=256 * 1024 * 1024):
+    # Copies CPU tensors into shared page-locked buffers, one host allocation per chunk
+    # instead of one per tensor. The chunk size bounds the extra RAM held during the copy.
+    def pin_chunk(chunk, chunk_bytes):
+        buffer = torch.empty(chunk_bytes, dtype=torch.uint8, pin_memory=True)
+        offset = 0
+        for t in chunk:
+            data = t.data
+            pinned = buffer[offset:offset + data.nbytes].view(data.dtype).view(data.size())
+            pinned.copy_(data)
+            t.data = pinned
+            offset += (data.nbytes + 63) // 64 * 64
+
+    chunk, chunk_bytes = [], 0
+    for t in {id(t): t for t in tensors}.values():
+        data = t.data
+        if data.device.type != 'cpu' or data.numel() == 0 or data.is_pinned():
+            continue
+        size = (data.nbytes + 63) // 64 * 64
+        if chunk and chunk_bytes + size > chunk_size:
+            pin_chunk(chunk, chunk_bytes)
+            chunk, chunk_bytes = [], 0
+        chunk.append(t)
+        chunk_bytes += size
+
+    if chunk:
+        pin_chunk(chunk, chunk_bytes)
+    return
+
+
 def build_module_profile(model, model_gpu_memory_when_using_cpu_swap):
     all_modules = []
     legacy_modules = []
@@ -414,28 +436,32 @@ def build_module_profile(model, model_gpu_memory_when_using_cpu_swap):
             m.total_mem, m.weight_mem, m.extra_mem = module_size(m, return_split=True)
             legacy_modules.append(m)
 
-    gpu_modules = []
-    gpu_modules_only_extras = []
-    mem_counter = 0
-
-    for m in legacy_modules.copy():
-        gpu_modules.append(m)
-        legacy_modules.remove(m)
-        mem_counter += m.total_mem
-
-    for m in sorted(all_modules, key=lambda x: x.extra_mem).copy():
-        if mem_counter + m.extra_mem < model_gpu_memory_when_using_cpu_swap:
-            gpu_modules_only_extras.append(m)
-            all_modules.remove(m)
-            mem_counter += m.extra_mem
-
-    cpu_modules = all_modules
-
-    for m in sorted(gpu_modules_only_extras, key=lambda x: x.weight_mem).copy():
-        if mem_counter + m.weight_mem < model_gpu_memory_when_using_cpu_swap:
-            gpu_modules.append(m)
-            gpu_modules_only_extras.remove(m)
-            mem_counter += m.weight_mem
+    gpu_modules = legacy_modules
+    mem_counter = sum(m.total_mem for m in legacy_modules)
+
+    # Both greedy passes walk modules in ascending size while the counter only grows,
+    # so once one module does not fit none of the later ones do: each pass is a prefix cut.
+    all_modules.sort(key=lambda x: x.extra_mem)
+    cut = 0
+    for m in all_modules:
+        if mem_counter + m.extra_mem >= model_gpu_memory_when_using_cpu_swap:
+            break
+        mem_counter += m.extra_mem
+        cut += 1
+
+    gpu_modules_only_extras = all_modules[:cut]
+    cpu_modules = all_modules[cut:]
+
+    gpu_modules_only_extras.sort(key=lambda x: x.weight_mem)
+    cut = 0
+    for m in gpu_modules_only_extras:
+        if mem_counter + m.weight_mem >= model_gpu_memory_when_using_cpu_swap:
+            break
+        mem_counter += m.weight_mem
+        cut += 1
+
+    gpu_modules += gpu_modules_only_extras[:cut]
+    gpu_modules_only_extras = gpu_modules_only_extras[cut:]
 
     return gpu_modules, gpu_modules_only_extras, cpu_modules
 
@@ -447,10 +473,17 @@ class LoadedModel:
         self.device = model.load_device
         self.inclusive_memory = 0
         self.exclusive_memory = 0
+        self.model_gpu_memory = 0
 
     def compute_inclusive_exclusive_memory(self):
-        self.inclusive_memory = module_size(self.model.model, include_device=self.device)
-        self.exclusive_memory = module_size(self.model.model, exclude_device=self.device)
+        # same as module_size with include_device / exclude_device, in one walk over the parameters
+        self.inclusive_memory = 0
+        self.exclusive_memory = 0
+        for p in self.model.model.parameters():
+            if p.data.device == self.device:
+                self.inclusive_memory += parameter_size(p)
+            else:
+                self.exclusive_memory += parameter_size(p)
         return
 
     def model_load(self, model_gpu_memory_when_using_cpu_swap=-1):
@@ -472,6 +505,7 @@ class LoadedModel:
             raise e
 
         if do_not_need_cpu_swap:
+            self.model_gpu_memory = self.inclusive_memory + self.exclusive_memory
             print('All loaded to GPU.')
         else:
             gpu_modules, gpu_modules_only_extras, cpu_modules = build_module_profile(self.real_model, model_gpu_memory_when_using_cpu_swap)
@@ -480,16 +514,27 @@ class LoadedModel:
             mem_counter = 0
             swap_counter = 0
 
-            for m in gpu_modules:
-                m.to(self.device)
-                mem_counter += m.total_mem
+            if stream.should_use_stream():
+                # queue all uploads on the mover stream and let compute wait on it once
+                with stream.stream_context()(stream.mover_stream):
+                    for m in gpu_modules:
+                        m.to(self.device, non_blocking=True)
+                        mem_counter += m.total_mem
+                stream.current_stream.wait_stream(stream.mover_stream)
+            else:
+                for m in gpu_modules:
+                    m.to(self.device)
+                    mem_counter += m.total_mem
+
+            swapped_tensors = []
 
             for m in cpu_modules:
                 m.prev_parameters_manual_cast = m.parameters_manual_cast
                 m.parameters_manual_cast = True
                 m.to(self.model.offload_device)
                 if pin_memory:
-                    m._apply(lambda x: x.pin_memory())
+                    swapped_tensors.extend(m.parameters())
+                    swapped_tensors.extend(m.buffers())
                 swap_counter += m.total_mem
 
             for m in gpu_modules_only_extras:
@@ -497,15 +542,18 @@ class LoadedModel:
                 m.parameters_manual_cast = True
                 module_move(m, device=self.device, recursive=False, excluded_pattens=['weight'])
                 if hasattr(m, 'weight') and m.weight is not None:
+                    m.weight = utils.tensor2parameter(m.weight.to(self.model.offload_device))
                     if pin_memory:
-                        m.weight = utils.tensor2parameter(m.weight.to(self.model.offload_device).pin_memory())
-                    else:
-                        m.weight = utils.tensor2parameter(m.weight.to(self.model.offload_device))
+                        swapped_tensors.append(m.weight)
                 mem_counter += m.extra_mem
                 swap_counter += m.weight_mem
 
+            if pin_memory:
+                pin_tensors(swapped_tensors)
+
             swap_flag = 'Shared' if PIN_SHARED_MEMORY else 'CPU'
             method_flag = 'asynchronous' if stream.should_use_stream() else 'blocked'
+            self.model_gpu_memory = mem_counter
             print(f"{swap_flag} Swap Loaded ({method_flag} method): {swap_counter / (1024 * 1024):.2f} MB, GPU Loaded: {mem_counter / (1024 * 1024):.2f} MB")
 
             self.model_accelerated = True
@@ -550,13 +598,9 @@ def minimum_inference_memory():
 
 
 def unload_model_clones(model):
-    to_unload = []
-    for i in range(len(current_loaded_models)):
+    for i in range(len(current_loaded_models) - 1, -1, -1):
         if model.is_clone(current_loaded_models[i].model):
-            to_unload = [i] + to_unload
-
-    for i in to_unload:
-        current_loaded_models.pop(i).model_unload(avoid_model_moving=True)
+            current_loaded_models.pop(i).model_unload(avoid_model_moving=True)
 
 
 def free_memory(memory_required, device, keep_loaded=[], free_all=False):
@@ -573,9 +617,12 @@ def free_memory(memory_required, device, keep_loaded=[], free_all=False):
 
     offload_everything = ALWAYS_VRAM_OFFLOAD or vram_state == VRAMState.NO_VRAM
     unloaded_model = False
+    free_memory = None
     for i in range(len(current_loaded_models) - 1, -1, -1):
         if not offload_everything:
-            free_memory = get_free_memory(device)
+            if free_memory is None:
+                # queried once, then advanced by what each unloaded model held on the device
+                free_memory = get_free_memory(device)
             print(f"Current free memory is {free_memory / (1024 * 1024):.2f} MB ... ", end="")
             if free_memory > memory_required:
                 break
@@ -585,6 +632,9 @@ def free_memory(memory_required, device, keep_loaded=[], free_all=False):
                 m = current_loaded_models.pop(i)
                 print(f"Unload model {m.model.model.__class__.__name__} ", end="")
                 m.model_unload()
+                if free_memory is not None and m.model.offload_device != device:
+                    # an offload device that is this GPU (HIGH_VRAM, --always-gpu) frees nothing
+                    free_memory += m.model_gpu_memory
                 del m
                 unloaded_model = True
 
@@ -615,25 +665,24 @@ def load_models_gpu(models, memory_required=0, hard_memory_preservation=0):
     global vram_state
 
     execution_start_time = time.perf_counter()
-    memory_to_free = max(minimum_inference_memory(), memory_required) + hard_memory_preservation
-    memory_for_inference = minimum_inference_memory() + hard_memory_preservation
+    memory_for_inference = current_inference_memory + hard_memory_preservation
+    memory_to_free = max(current_inference_memory, memory_required) + hard_memory_preservation
 
     models_to_load = []
     models_already_loaded = []
     for x in models:
-        loaded_model = LoadedModel(x)
+        index = loaded_model_index(x)
 
-        if loaded_model in current_loaded_models:
-            index = current_loaded_models.index(loaded_model)
-            current_loaded_models.insert(0, current_loaded_models.pop(index))
+        if index >= 0:
+            loaded_model = current_loaded_models.pop(index)
+            current_loaded_models.insert(0, loaded_model)
             models_already_loaded.append(loaded_model)
         else:
-            models_to_load.append(loaded_model)
+            models_to_load.append(LoadedModel(x))
 
     if len(models_to_load) == 0:
-        devs = set(map(lambda a: a.device, models_already_loaded))
-        for d in devs:
-            if d != torch.device("cpu"):
+        for d in {m.device for m in models_already_loaded}:
+            if d.type != 'cpu':
                 free_memory(memory_to_free, d, models_already_loaded)
 
         moving_time = time.perf_counter() - execution_start_time
@@ -645,13 +694,13 @@ def load_models_gpu(models, memory_required=0, hard_memory_preservation=0):
     for loaded_model in models_to_load:
         unload_model_clones(loaded_model.model)
 
-    total_memory_required = {}
+    total_memory_required = defaultdict(float)
     for loaded_model in models_to_load:
         loaded_model.compute_inclusive_exclusive_memory()
-        total_memory_required[loaded_model.device] = total_memory_required.get(loaded_model.device, 0) + loaded_model.exclusive_memory + loaded_model.inclusive_memory * 0.25
+        total_memory_required[loaded_model.device] += loaded_model.exclusive_memory + loaded_model.inclusive_memory * 0.25
 
     for device in total_memory_required:
-        if device != torch.device("cpu"):
+        if device.type != 'cpu':
             free_memory(total_memory_required[device] * 1.3 + memory_to_free, device, models_already_loaded)
 
     for loaded_model in models_to_load:
@@ -694,6 +743,13 @@ def load_model_gpu(model):
     return load_models_gpu([model])
 
 
+def loaded_model_index(model):
+    for i, m in enumerate(current_loaded_models):
+        if m.model is model:
+            return i
+    return -1
+
+
 def cleanup_models():
     to_delete = []
     for i in range(len(current_loaded_models)):
@@ -706,25 +762,26 @@ def cleanup_models():
         del x
 
 
+DTYPE_SIZES = {
+    torch.float16: 2,
+    torch.bfloat16: 2,
+    torch.float32: 4,
+}
+
+
 def dtype_size(dtype):
-    dtype_size = 4
-    if dtype == torch.float16 or dtype == torch.bfloat16:
-        dtype_size = 2
-    elif dtype == torch.float32:
-        dtype_size = 4
-    else:
-        try:
-            dtype_size = dtype.itemsize
-        except:  # Old pytorch doesn't have .itemsize
-            pass
-    return dtype_size
+    size = DTYPE_SIZES.get(dtype, None)
+    if size is None:
+        # Old pytorch doesn't have .itemsize
+        size = getattr(dtype, 'itemsize', 4)
+    return size
 
 
 def unet_offload_device():
     if vram_state == VRAMState.HIGH_VRAM:
         return get_torch_device()
     else:
-        return torch.device("cpu")
+        return cpu
 
 
 def unet_inital_load_device(parameters, dtype):
@@ -732,7 +789,7 @@ def unet_inital_load_device(parameters, dtype):
     if vram_state == VRAMState.HIGH_VRAM:
         return torch_dev
 
-    cpu_dev = torch.device("cpu")
+    cpu_dev = cpu
     if ALWAYS_VRAM_OFFLOAD:
         return cpu_dev
 
@@ -786,7 +843,7 @@ def text_encoder_offload_device():
     if args.always_gpu:
         return get_torch_device()
     else:
-        return torch.device("cpu")
+        return cpu
 
 
 def text_encoder_device():
@@ -796,9 +853,9 @@ def text_encoder_device():
         if should_use_fp16(prioritize_performance=False):
             return get_torch_device()
         else:
-            return torch.device("cpu")
+            return cpu
     else:
-        return torch.device("cpu")
+        return cpu
 
 
 def text_encoder_dtype(device=None):
@@ -821,12 +878,12 @@ def intermediate_device():
     if args.always_gpu:
         return get_torch_device()
     else:
-        return torch.device("cpu")
+        return cpu
 
 
 def vae_device():
     if args.vae_in_cpu:
-        return torch.device("cpu")
+        return cpu
     return get_torch_device()
 
 
@@ -834,11 +891,22 @@ def vae_offload_device():
     if args.always_gpu:
         return get_torch_device()
     else:
-        return torch.device("cpu")
+        return cpu
+
+
+vae_dtype_cache = {}
 
 
 def vae_dtype(device=None, allowed_dtypes=[]):
-    global VAE_DTYPES
+    # Every input to the choice is fixed after startup, so resolve each request once.
+    key = (device, tuple(allowed_dtypes))
+    dtype = vae_dtype_cache.get(key, None)
+    if dtype is None:
+        dtype = vae_dtype_cache[key] = resolve_vae_dtype(device, allowed_dtypes)
+    return dtype
+
+
+def resolve_vae_dtype(device, allowed_dtypes):
     if args.vae_in_fp16:
         return torch.float16
     elif args.vae_in_bf16:
@@ -934,6 +1002,9 @@ def force_channels_last():
 
 
 def cast_to_device(tensor, device, dtype, copy=False):
+    if not copy and tensor.dtype is dtype and tensor.device == device:
+        return tensor
+
     device_supports_cast = False
     if tensor.dtype == torch.float32 or tensor.dtype == torch.float16:
         device_supports_cast = True
@@ -992,26 +1063,38 @@ def pytorch_attention_flash_attention():
     return False
 
 
+MAC_VERSION = platform.mac_ver()[0]
+
+FORCE_UPCAST_ATTENTION = args.force_upcast_attention or MAC_VERSION in ['14.5']  # black image bug on OSX Sonoma 14.5
+
+
 def force_upcast_attention_dtype():
-    upcast = args.force_upcast_attention
-    try:
-        if platform.mac_ver()[0] in ['14.5']:  # black image bug on OSX Sonoma 14.5
-            upcast = True
-    except:
-        pass
-    if upcast:
+    if FORCE_UPCAST_ATTENTION:
         return torch.float32
     else:
         return None
 
 
+virtual_memory_cache = [0.0, 0]
+
+
+def get_available_ram(ttl=0.05):
+    # psutil reads /proc/meminfo (or sysctl) on every call; sizing decisions don't need
+    # fresher than a few tens of milliseconds.
+    now = time.monotonic()
+    if now - virtual_memory_cache[0] >= ttl:
+        virtual_memory_cache[0] = now
+        virtual_memory_cache[1] = psutil.virtual_memory().available
+    return virtual_memory_cache[1]
+
+
 def get_free_memory(dev=None, torch_free_too=False):
     global directml_enabled
     if dev is None:
         dev = get_torch_device()
 
     if hasattr(dev, 'type') and (dev.type == 'cpu' or dev.type == 'mps'):
-        mem_free_total = psutil.virtual_memory().available
+        mem_free_total = get_available_ram()
         mem_free_torch = mem_free_total
     else:
         if directml_enabled:
@@ -1025,9 +1108,14 @@ def get_free_memory(dev=None, torch_free_too=False):
             mem_free_xpu = torch.xpu.get_device_properties(dev).total_memory - mem_reserved
             mem_free_total = mem_free_xpu + mem_free_torch
         else:
-            stats = torch.cuda.memory_stats(dev)
-            mem_active = stats['active_bytes.all.current']
-            mem_reserved = stats['reserved_bytes.all.current']
+            # the nested form skips memory_stats flattening every counter into one dict in Python
+            stats = torch.cuda.memory_stats_as_nested_dict(dev)
+            if stats:
+                mem_active = stats['active_bytes']['all']['current']
+                mem_reserved = stats['reserved_bytes']['all']['current']
+            else:
+                # empty before the allocator is initialized, and on some ROCm builds
+                mem_active = mem_reserved = 0
             mem_free_cuda, _ = torch.cuda.mem_get_info(dev)
             mem_free_torch = mem_reserved - mem_active
             mem_free_total = mem_free_cuda + mem_free_torch
@@ -1049,10 +1137,7 @@ def mps_mode():
 
 
 def is_device_type(device, type):
-    if hasattr(device, 'type'):
-        if (device.type == type):
-            return True
-    return False
+    return getattr(device, 'type', None) == type
 
 
 def is_device_cpu(device):
@@ -1068,6 +1153,19 @@ def is_device_cuda(device):
 
 
 def should_use_fp16(device=None, model_params=0, prioritize_performance=True, manual_cast=False):
+    support = fp16_support(device, manual_cast)
+    if support is not None:
+        return support
+
+    # For storage dtype
+    free_model_memory = (get_free_memory() * 0.9 - minimum_inference_memory())
+    return (not prioritize_performance) or model_params * 4 > free_model_memory
+
+
+@functools.lru_cache(maxsize=None)
+def fp16_support(device, manual_cast):
+    # Everything in the fp16 decision that is fixed for a device, cached.
+    # None means the card can store in fp16 but it should only be done when memory is short.
     global directml_enabled
 
     if device is not None:
@@ -1099,38 +1197,45 @@ def should_use_fp16(device=None, model_params=0, prioritize_performance=True, ma
     if torch.version.hip:
         return True
 
-    props = torch.cuda.get_device_properties("cuda")
+    props = get_cuda_device_properties("cuda")
     if props.major >= 8:
         return True
 
     if props.major < 6:
         return False
 
-    nvidia_10_series = ["1080", "1070", "titan x", "p3000", "p3200", "p4000", "p4200", "p5000", "p5200", "p6000", "1060", "1050", "p40", "p100", "p6", "p4"]
-    for x in nvidia_10_series:
-        if x in props.name.lower():
-            if manual_cast:
-                # For storage dtype
-                free_model_memory = (get_free_memory() * 0.9 - minimum_inference_memory())
-                if (not prioritize_performance) or model_params * 4 > free_model_memory:
-                    return True
-            else:
-                # For computation dtype
-                return False  # Flux on 1080 can store model in fp16 to reduce swap, but computation must be fp32, otherwise super slow.
+    name = props.name.lower()
+    if any(x in name for x in nvidia_10_series):
+        if manual_cast:
+            # For storage dtype, depends on free memory
+            return None
+        else:
+            # For computation dtype
+            return False  # Flux on 1080 can store model in fp16 to reduce swap, but computation must be fp32, otherwise super slow.
 
     if props.major < 7:
         return False
 
     # FP16 is just broken on these cards
-    nvidia_16_series = ["1660", "1650", "1630", "T500", "T550", "T600", "MX550", "MX450", "CMP 30HX", "T2000", "T1000", "T1200"]
-    for x in nvidia_16_series:
-        if x in props.name:
-            return False
+    if any(x in props.name for x in nvidia_16_series):
+        return False
 
     return True
 
 
 def should_use_bf16(device=None, model_params=0, prioritize_performance=True, manual_cast=False):
+    support = bf16_support(device, manual_cast)
+    if support is not None:
+        return support
+
+    # For storage dtype
+    free_model_memory = (get_free_memory() * 0.9 - minimum_inference_memory())
+    return (not prioritize_performance) or model_params * 4 > free_model_memory
+
+
+@functools.lru_cache(maxsize=None)
+def bf16_support(device, manual_cast):
+    # Same as fp16_support, for bf16.
     if device is not None:
         if is_device_cpu(device):  # TODO ? bf16 works on CPU but is extremely slow
             return False
@@ -1157,7 +1262,7 @@ def should_use_bf16(device=None, model_params=0, prioritize_performance=True, ma
     if device is None:
         device = torch.device("cuda")
 
-    props = torch.cuda.get_device_properties(device)
+    props = get_cuda_device_properties(device)
     if props.major >= 8:
         return True
 
@@ -1165,32 +1270,58 @@ def should_use_bf16(device=None, model_params=0, prioritize_performance=True, ma
         # This device is an old enough device but bf16 somewhat reports supported.
         # So in this case bf16 should only be used as storge dtype
         if manual_cast:
-            # For storage dtype
-            free_model_memory = (get_free_memory() * 0.9 - minimum_inference_memory())
-            if (not prioritize_performance) or model_params * 4 > free_model_memory:
-                return True
+            # For storage dtype, depends on free memory
+            return None
 
     return False
 
 
-def can_install_bnb():
+def supports_fp8_compute(device=None):
+    # fp8 tensor cores need Ada/Hopper (sm_89+) and torch._scaled_mm
+    if not is_nvidia() or not hasattr(torch, '_scaled_mm'):
+        return False
+
+    if device is None:
+        device = torch.device("cuda")
+
+    if not is_device_cuda(device):
+        return False
+
+    props = get_cuda_device_properties(device)
+    return (props.major, props.minor) >= (8, 9)
+
+
+def get_cuda_version():
     try:
-        if not torch.cuda.is_available():
-            return False
+        return tuple(int(x) for x in torch.version.cuda.split('.'))
+    except (AttributeError, ValueError):
+        return ()
 
-        cuda_version = tuple(int(x) for x in torch.version.cuda.split('.'))
 
-        if cuda_version >= (11, 7):
-            return True
+CUDA_VERSION = get_cuda_version()
+
 
+def should_use_fp8(device=None, storage_dtype=None):
+    # fp8 is only a compute dtype here when the weights are already stored as e4m3.
+    if not args.fast_fp8_matmul or not hasattr(torch, 'float8_e4m3fn'):
         return False
-    except:
+
+    if storage_dtype is not None and storage_dtype != torch.float8_e4m3fn:
         return False
 
+    return supports_fp8_compute(device)
+
+
+def can_install_bnb():
+    return torch.cuda.is_available() and CUDA_VERSION >= (11, 7)
+
 
 signal_empty_cache = False
 
 
+EMPTY_CACHE_THRESHOLD = 512 * 1024 * 1024
+
+
 def soft_empty_cache(force=False):
     global cpu_state, signal_empty_cache
     if cpu_state == CPUState.MPS:
@@ -1198,12 +1329,22 @@ def soft_empty_cache(force=False):
     elif is_intel_xpu():
         torch.xpu.empty_cache()
     elif torch.cuda.is_available():
-        if force or is_nvidia():  # This seems to make things worse on ROCm so I only do it for cuda
+        if force or args.aggressive_empty_cache:
             torch.cuda.empty_cache()
             torch.cuda.ipc_collect()
+        elif is_nvidia():  # This seems to make things worse on ROCm so I only do it for cuda
+            # empty_cache synchronizes the device and the next load has to cudaMalloc the blocks again,
+            # so a small idle pool is kept. The stats lookup is host-side only.
+            device = get_torch_device()
+            if torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device) > EMPTY_CACHE_THRESHOLD:
+                torch.cuda.empty_cache()
     signal_empty_cache = False
     return
 
 
 def unload_all_models():
     free_memory(1e30, get_torch_device(), free_all=True)
+
+    if PIN_SHARED_MEMORY and hasattr(torch._C, '_host_emptyCache'):
+        # pinned swap chunks that were freed sit in the host caching allocator until released
+        torch._C._host_emptyCache()
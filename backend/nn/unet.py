@@ -93,12 +93,19 @@ class TimestepEmbedSequential(nn.Sequential, TimestepBlock):
 
 
 class Timestep(nn.Module):
-    def __init__(self, dim):
+    def __init__(self, dim, max_period=10000):
         super().__init__()
         self.dim = dim
+        half = dim // 2
+        self.register_buffer('freqs', torch.exp(-math.log(max_period) * torch.arange(start=0, end=half, dtype=torch.float32) / half), persistent=False)
 
     def forward(self, t):
-        return timestep_embedding(t, self.dim)
+        # Same as timestep_embedding, but with the frequency basis computed once
+        args = t[:, None].float() * self.freqs.to(device=t.device)[None]
+        embedding = torch.cat([torch.cos(args), torch.sin(args)], dim=-1)
+        if self.dim % 2:
+            embedding = torch.cat([embedding, torch.zeros_like(embedding[:, :1])], dim=-1)
+        return embedding
 
 
 class GEGLU(nn.Module):
@@ -116,10 +116,52 @@ def cleanup_cache():
     return
 
 
+fp8_unit_scales = {}
+
+
+def fp8_weight_scale(layer, device):
+    # _scaled_mm wants float32 scalars on the compute device. Weights cast to e4m3 without
+    # a checkpoint scale share one unit scale per device instead of allocating it per forward.
+    if layer.scale_weight is not None:
+        return layer.scale_weight.to(device=device, dtype=torch.float32).reshape(())
+
+    scale = fp8_unit_scales.get(device, None)
+    if scale is None:
+        scale = fp8_unit_scales[device] = torch.ones((), device=device, dtype=torch.float32)
+    return scale
+
+
+def fp8_linear(layer, x):
+    # Native fp8 matmul on the e4m3 weight. Returns None when the layer can not take this path.
+    if layer.weight is None or layer.weight.dtype != torch.float8_e4m3fn:
+        return None
+    if x.device.type != 'cuda' or x.dtype not in [torch.float16, torch.bfloat16]:
+        return None
+    if layer.scale_weight is not None and layer.scale_weight.numel() != 1:
+        return None
+    if getattr(layer, 'forge_online_loras', None) is not None:
+        return None
+    if layer.in_features % 16 != 0 or layer.out_features % 16 != 0:
+        return None
+
+    weight, bias, signal = weights_manual_cast(layer, x, skip_weight_dtype=True)
+    with main_stream_worker(weight, bias, signal):
+        x_2d = x.reshape(-1, x.shape[-1])
+        # per-tensor amax scaling keeps small activations from flushing to zero in e4m3
+        scale_a = (x_2d.abs().amax().float() / 448).clamp(min=1e-12)
+        x_fp8 = torch.clamp(x_2d / scale_a, min=-448, max=448).to(torch.float8_e4m3fn)
+        scale_b = fp8_weight_scale(layer, x.device)
+        out = torch._scaled_mm(x_fp8, weight.t(), scale_a=scale_a, scale_b=scale_b, bias=bias, out_dtype=x.dtype)
+        if isinstance(out, tuple):  # older torch also returns amax
+            out = out[0]
+        return out.reshape(*x.shape[:-1], layer.out_features)
+
+
 current_device = None
 current_dtype = None
 current_manual_cast_enabled = False
 current_bnb_dtype = None
+current_fp8_matmul_enabled = False
 
 
 class ForgeOperations:
@@ -133,6 +175,7 @@ class ForgeOperations:
             self.scale_weight = None
             self.bias = None
             self.parameters_manual_cast = current_manual_cast_enabled
+            self.fp8_matmul = current_fp8_matmul_enabled
 
         def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
             if hasattr(self, 'dummy'):
@@ -147,6 +190,11 @@ class ForgeOperations:
                 super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
 
         def forward(self, x):
+            if self.fp8_matmul:
+                out = fp8_linear(self, x)
+                if out is not None:
+                    return out
+
             if self.parameters_manual_cast:
                 weight, bias, signal = weights_manual_cast(self, x)
                 with main_stream_worker(weight, bias, signal):
@@ -439,10 +487,10 @@ class ForgeOperationsGGUF(ForgeOperations):
 
 
 @contextlib.contextmanager
-def using_forge_operations(operations=None, device=None, dtype=None, manual_cast_enabled=False, bnb_dtype=None):
-    global current_device, current_dtype, current_manual_cast_enabled, current_bnb_dtype
+def using_forge_operations(operations=None, device=None, dtype=None, manual_cast_enabled=False, bnb_dtype=None, fp8_matmul_enabled=False):
+    global current_device, current_dtype, current_manual_cast_enabled, current_bnb_dtype, current_fp8_matmul_enabled
 
-    current_device, current_dtype, current_manual_cast_enabled, current_bnb_dtype = device, dtype, manual_cast_enabled, bnb_dtype
+    current_device, current_dtype, current_manual_cast_enabled, current_bnb_dtype, current_fp8_matmul_enabled = device, dtype, manual_cast_enabled, bnb_dtype, fp8_matmul_enabled
 
     if operations is None:
         if bnb_dtype in ['gguf']:
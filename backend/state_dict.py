@@ -40,6 +40,28 @@ def try_filter_state_dict(sd, prefix_list, new_prefix=''):
     return {}
 
 
+def partition_state_dict(sd, prefix_lists, new_prefix=''):
+    # Same as try_filter_state_dict for each target in order, but moves the keys out of sd in a single pass.
+    # Each target only probes the keys that earlier targets have not claimed, as the sequential calls would.
+    routes = []
+    results = {}
+    for target, prefix_list in prefix_lists.items():
+        results[target] = {}
+        remaining = [k for k in sd.keys() if not any(k.startswith(p) for p, _ in routes)]
+        for prefix in prefix_list:
+            if any(k.startswith(prefix) for k in remaining):
+                routes.append((prefix, results[target]))
+                break
+
+    for k in list(sd.keys()):
+        for prefix, new_sd in routes:
+            if k.startswith(prefix):
+                new_sd[new_prefix + k[len(prefix):]] = sd.pop(k)
+                break
+
+    return results
+
+
 def transformers_convert(sd, prefix_from, prefix_to, number):
     keys_to_replace = {
         "{}positional_embedding": "{}embeddings.position_embedding.weight",
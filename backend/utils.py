@@ -2,8 +2,10 @@ import gguf
 import torch
 import os
 import json
+from collections import Counter
 import safetensors.torch
 import backend.misc.checkpoint_pickle
+from backend.args import args
 from backend.operations_gguf import ParameterGGUF
 
 
@@ -35,9 +37,19 @@ def load_torch_file(ckpt, safe_load=False, device=None):
                 print("Warning torch.load doesn't support weights_only on this pytorch version, loading unsafely.")
                 safe_load = False
         if safe_load:
-            pl_sd = torch.load(ckpt, map_location=device, weights_only=True)
+            load_kwargs = dict(weights_only=True)
         else:
-            pl_sd = torch.load(ckpt, map_location=device, pickle_module=backend.misc.checkpoint_pickle)
+            load_kwargs = dict(pickle_module=backend.misc.checkpoint_pickle)
+        pl_sd = None
+        if args.mmap_torch_files:
+            # storages are paged in from disk on first access instead of being read upfront
+            try:
+                pl_sd = torch.load(ckpt, map_location=device, mmap=True, **load_kwargs)
+            except (TypeError, RuntimeError) as e:
+                # torch < 2.1 has no mmap argument and legacy (non zip) files cannot be mapped
+                print(f"Cannot mmap {ckpt}, loading it normally: {e}")
+        if pl_sd is None:
+            pl_sd = torch.load(ckpt, map_location=device, **load_kwargs)
         if "global_step" in pl_sd:
             print(f"Global Step: {pl_sd['global_step']}")
         if "state_dict" in pl_sd:
@@ -161,15 +173,6 @@ def get_state_dict_after_quant(model, prefix=''):
 
 
 def beautiful_print_gguf_state_dict_statics(state_dict):
-    from gguf.constants import GGMLQuantizationType
-    type_counts = {}
-    for k, v in state_dict.items():
-        gguf_cls = getattr(v, 'gguf_cls', None)
-        if gguf_cls is not None:
-            type_name = gguf_cls.__name__
-            if type_name in type_counts:
-                type_counts[type_name] += 1
-            else:
-                type_counts[type_name] = 1
-    print(f'GGUF state dict: {type_counts}')
+    type_counts = Counter(gguf_cls.__name__ for v in state_dict.values() if (gguf_cls := getattr(v, 'gguf_cls', None)) is not None)
+    print(f'GGUF state dict: {dict(type_counts)}')
     return
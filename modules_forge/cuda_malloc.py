@@ -59,19 +59,24 @@ def cuda_malloc_supported():
     return True
 
 
+def import_torch_version():
+    # Read torch/version.py without importing torch, the allocator config must be set before that
+    module = None
+    torch_spec = importlib.util.find_spec("torch")
+    for folder in torch_spec.submodule_search_locations:
+        ver_file = os.path.join(folder, "version.py")
+        if os.path.isfile(ver_file):
+            spec = importlib.util.spec_from_file_location("torch_version_import", ver_file)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+    return module
+
+
 def try_cuda_malloc():
     do_cuda_malloc = False
 
     try:
-        version = ""
-        torch_spec = importlib.util.find_spec("torch")
-        for folder in torch_spec.submodule_search_locations:
-            ver_file = os.path.join(folder, "version.py")
-            if os.path.isfile(ver_file):
-                spec = importlib.util.spec_from_file_location("torch_version_import", ver_file)
-                module = importlib.util.module_from_spec(spec)
-                spec.loader.exec_module(module)
-                version = module.__version__
+        version = import_torch_version().__version__
         if int(version[0]) >= 2:
             do_cuda_malloc = cuda_malloc_supported()
     except:
@@ -90,3 +95,32 @@ def try_cuda_malloc():
     else:
         print('Failed to use cudaMallocAsync backend.')
     return
+
+
+def try_expandable_segments():
+    # Lets the caching allocator grow segments in place instead of stranding
+    # VRAM in fragments while models are moved in and out of the GPU.
+    if os.name == 'nt':
+        return  # not supported by the Windows allocator
+
+    try:
+        torch_version = import_torch_version()
+        major, minor = torch_version.__version__.split('.')[:2]
+        if (int(major), int(minor)) < (2, 1):
+            return  # older allocators reject the option
+        if torch_version.cuda is None or getattr(torch_version, 'hip', None) is not None:
+            return  # only enabled for the NVIDIA CUDA allocator, ROCm and CPU builds are left alone
+    except:
+        return
+
+    env_var = os.environ.get('PYTORCH_CUDA_ALLOC_CONF', None)
+    if env_var is None:
+        env_var = 'expandable_segments:True'
+    elif 'expandable_segments' in env_var or 'cudaMallocAsync' in env_var:
+        return  # respect what the user configured
+    else:
+        env_var += ',expandable_segments:True'
+
+    os.environ['PYTORCH_CUDA_ALLOC_CONF'] = env_var
+    print('Using expandable_segments in the CUDA allocator.')
+    return
@@ -54,6 +54,9 @@ def initialize_forge():
     if args.cuda_malloc:
         from modules_forge.cuda_malloc import try_cuda_malloc
         try_cuda_malloc()
+    elif not args.disable_expandable_segments:
+        from modules_forge.cuda_malloc import try_expandable_segments
+        try_expandable_segments()
 
     from backend import memory_management
     import torch